@@ -1,21 +1,325 @@
+import json
 import logging
+import os
+import shutil
+import sys
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from os.path import basename
 from pathlib import Path
 from subprocess import run
-from tempfile import TemporaryDirectory
-from typing import Any, Dict, Iterator, List, Literal, Union
-
-import yaml
-from chromalog.mark.helpers.simple import important
+from tempfile import TemporaryDirectory, mkdtemp
+from typing import Any, Callable, Deque, Dict, List, Literal, NamedTuple, Optional, Set, TextIO, Tuple, Union
 
 log = logging.getLogger(__name__)
 
 
+def _intern(value: Optional[str]) -> Optional[str]:
+    # String literals in this module are already interned by the compiler,
+    # but user/group names passed in by callers are not, and the same few
+    # names are repeated in every task of a large playbook.
+    return None if value is None else sys.intern(value)
+
+
+def _dump(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def _ansible_env(
+    *,
+    fact_cache_dir: Path = None,
+    forks: int = None,
+    pipelining: bool = None,
+) -> Dict[str, str]:
+    # Settings are passed to ansible-playbook as environment variables so that
+    # they are layered on top of whatever $ANSIBLE_CONFIG already provides.
+    # Options which are None are left to $ANSIBLE_CONFIG.
+    env = dict(os.environ)
+    if forks is not None:
+        env['ANSIBLE_FORKS'] = str(forks)
+    if pipelining is not None:
+        # https://docs.ansible.com/ansible/latest/plugins/connection/ssh.html#parameter-pipelining
+        env['ANSIBLE_PIPELINING'] = str(pipelining)
+    if fact_cache_dir is not None:
+        # https://docs.ansible.com/ansible/latest/plugins/cache.html
+        env['ANSIBLE_GATHERING'] = 'smart'
+        env['ANSIBLE_CACHE_PLUGIN'] = 'jsonfile'
+        env['ANSIBLE_CACHE_PLUGIN_CONNECTION'] = os.fspath(fact_cache_dir.absolute())
+        env['ANSIBLE_CACHE_PLUGIN_TIMEOUT'] = '86400'
+    return env
+
+
+def _play_header(
+    *,
+    hosts: str,
+    strategy: str = None,
+    serial: Union[int, str, List[Union[int, str]]] = None,
+) -> Dict[str, Any]:
+    # everything that goes into a play apart from its tasks
+    header: Dict[str, Any] = {"hosts": hosts}
+    if strategy is not None:
+        header["strategy"] = strategy
+    if serial is not None:
+        header["serial"] = serial
+    return header
+
+
+class _Task(ABC):
+    # Tasks from the most common builders are stored in these slotted objects
+    # rather than as nested dicts, which keeps large Blocks much smaller while
+    # they are being built. They are turned into dicts by Block.get_tasks().
+    __slots__ = ('name', )
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @abstractmethod
+    def to_dict(self) -> Dict[str, Any]:
+        ...
+
+
+class _AptTask(_Task):
+    __slots__ = ('packages', 'update_cache')
+
+    def __init__(self, name: str, *, packages: List[str], update_cache: bool):
+        super().__init__(name)
+        self.packages = packages
+        self.update_cache = update_cache
+
+    def to_dict(self) -> Dict[str, Any]:
+        detail: Dict[str, Any] = {
+            "name": self.packages,
+        }
+
+        if self.update_cache is not False:
+            detail['update_cache'] = self.update_cache
+
+        return {
+            "name": self.name,
+            "become": True,
+            "apt": detail
+        }
+
+
+class _FileTask(_Task):
+    __slots__ = ('become_user', 'path', 'state', 'src', 'owner', 'group', 'mode', 'force')
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        become_user: str = None,
+        path: str,
+        state: str,
+        src: str = None,
+        owner: str = None,
+        group: str = None,
+        mode: Union[str, int] = None,
+        force: bool = None,
+    ):
+        super().__init__(name)
+        self.become_user = _intern(become_user)
+        self.path = path
+        self.state = state
+        self.src = src
+        self.owner = _intern(owner)
+        self.group = _intern(group)
+        self.mode = mode
+        self.force = force
+
+    def to_dict(self) -> Dict[str, Any]:
+        detail: Dict[str, Any] = {
+            "path": self.path,
+            "state": self.state,
+        }
+        if self.src is not None:
+            detail['src'] = self.src
+        if self.owner is not None:
+            detail['owner'] = self.owner
+        if self.group is not None:
+            detail['group'] = self.group
+        if self.mode is not None:
+            detail['mode'] = self.mode
+        if self.force is not None:
+            detail['force'] = self.force
+
+        task: Dict[str, Any] = {
+            "name": self.name,
+            "become": True,
+        }
+        if self.become_user is not None:
+            task['become_user'] = self.become_user
+        task['file'] = detail
+        return task
+
+
+class _CopyTask(_Task):
+    __slots__ = ('dest', 'src', 'content', 'mode', 'owner', 'root')
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        dest: str,
+        src: str = None,
+        content: str = None,
+        mode: Union[int, str] = None,
+        owner: str = None,
+        root: bool = False,
+    ):
+        super().__init__(name)
+        self.dest = dest
+        self.src = src
+        self.content = content
+        self.mode = mode
+        self.owner = _intern(owner)
+        self.root = root
+
+    def to_dict(self) -> Dict[str, Any]:
+        # https://docs.ansible.com/ansible/latest/modules/copy_module.html
+        how: Dict[str, Any] = {
+            "dest": self.dest,
+            "backup": True,
+        }
+
+        if self.src is not None:
+            how['src'] = self.src
+        else:
+            how['content'] = self.content
+
+        if self.mode is not None:
+            how['mode'] = self.mode
+
+        task: Dict[str, Any] = {
+            "name": self.name,
+            "copy": how,
+        }
+
+        if self.root or self.owner:
+            task["become"] = True
+            task["become_user"] = 'root'
+
+        if self.owner:
+            how['owner'] = self.owner
+
+        return task
+
+
+class _CommandTask(_Task):
+    __slots__ = ('argv', 'chdir', 'become_user')
+
+    def __init__(self, name: str, *, argv: List[str], chdir: str = None, become_user: str = None):
+        super().__init__(name)
+        self.argv = argv
+        self.chdir = chdir
+        self.become_user = _intern(become_user)
+
+    def to_dict(self) -> Dict[str, Any]:
+        # See https://docs.ansible.com/ansible/latest/modules/command_module.html#command-module
+        detail: Dict[str, Any] = {
+            "argv": self.argv,
+        }
+        if self.chdir is not None:
+            detail['chdir'] = self.chdir
+        task: Dict[str, Any] = {
+            "name": self.name,
+            "command": detail,
+        }
+        if self.become_user is not None:
+            task['become'] = True
+            task['become_user'] = self.become_user
+        return task
+
+
+class _UploadBatch:
+    # Files from consecutive Block.copy_many() calls for the same destination.
+    # These are uploaded with a single synchronize task over a directory of
+    # symlinks, which is only created when the playbook is written.
+    __slots__ = ('destdir', 'owner', 'mode', 'root', 'srcs')
+
+    def __init__(self, destdir: str, *, owner: Optional[str], mode: Union[int, str, None], root: bool):
+        self.destdir = destdir
+        self.owner = _intern(owner)
+        self.mode = mode
+        self.root = root
+        self.srcs: List[Path] = []
+
+    def to_dicts(self, staging: Optional[Path]) -> List[Dict[str, Any]]:
+        destdir = self.destdir.rstrip('/')
+        if staging is None or len(self.srcs) == 1:
+            return [
+                _CopyTask(
+                    f"Upload {src.name} to {destdir}/{src.name}",
+                    dest=f"{destdir}/{src.name}",
+                    src=os.fspath(src),
+                    mode=self.mode,
+                    owner=self.owner,
+                    root=self.root,
+                ).to_dict()
+                for src in self.srcs
+            ]
+
+        linkdir = Path(mkdtemp(dir=staging))
+        for src in self.srcs:
+            link = linkdir / src.name
+            if link.is_symlink():
+                # same as with sequential copies, the last file wins
+                link.unlink()
+            link.symlink_to(src)
+
+        # https://docs.ansible.com/ansible/latest/collections/ansible/posix/synchronize_module.html
+        how: Dict[str, Any] = {
+            "src": f"{linkdir}/",
+            "dest": f"{destdir}/",
+            # upload the files the links point to, but don't copy local
+            # ownership/permissions across like archive mode would
+            "copy_links": True,
+            "archive": False,
+            "recursive": True,
+            "times": True,
+        }
+        rsync_opts = []
+        if self.owner:
+            # rsync ignores --chown unless it is also told to set the owner;
+            # like copy(), leave the group alone
+            how['owner'] = True
+            rsync_opts.append(f"--chown={self.owner}")
+        if self.mode is not None:
+            # --chmod only affects existing files when perms are being set
+            how['perms'] = True
+            mode = f"{self.mode:o}" if isinstance(self.mode, int) else self.mode
+            rsync_opts.append(f"--chmod=F{mode}")
+        if rsync_opts:
+            how['rsync_opts'] = rsync_opts
+
+        task: Dict[str, Any] = {
+            "name": f"Upload {len(self.srcs)} files to {self.destdir}",
+            "ansible.posix.synchronize": how,
+        }
+
+        if self.root:
+            task["become"] = True
+            task["become_user"] = 'root'
+
+        return [task]
+
+
+_AnyTask = Union["Block", _Task, _UploadBatch, Dict[str, Any]]
+
+
 class Block:
     def __init__(self, name: str, *, root: Path):
         self._name: str = name
-        self._tasks: List[Union[Block, Dict[str, Any]]] = []
+        self._tasks: List[_AnyTask] = []
         self._root = root
+        # consecutive apt_present() calls with the same options are merged into
+        # a single apt task, see _flush_apt()
+        self._pending_apt_options: Tuple[bool] = (False, )
+        self._pending_apt: List[Tuple[str, List[str]]] = []
+        # files from consecutive copy_many() calls to the same destination are
+        # uploaded with a single synchronize task, see _UploadBatch
+        self._pending_upload: Optional[_UploadBatch] = None
 
     def apt_present(
         self,
@@ -27,19 +331,44 @@ class Block:
         if title is None:
             title = f"Install {', '.join(packages)}"
 
-        detail: Dict[str, Any] = {
-            "name": packages,
-        }
+        # FIXME: do we want to run apt-update first?
+        self._flush_copies()
+        options = (update_cache, )
+        if options != self._pending_apt_options:
+            self._flush_apt()
+            self._pending_apt_options = options
+        self._pending_apt.append((title, packages))
+
+    def _flush_apt(self) -> None:
+        calls = self._pending_apt
+        if not calls:
+            return
+        self._pending_apt = []
+
+        (update_cache, ) = self._pending_apt_options
+        if len(calls) == 1:
+            title, packages = calls[0]
+        else:
+            # dict.fromkeys() removes duplicates but preserves order
+            packages = list(dict.fromkeys(p for _, pkgs in calls for p in pkgs))
+            title = f"Install {len(packages)} packages"
 
-        if update_cache is not False:
-            detail['update_cache'] = update_cache
+        self._tasks.append(_AptTask(title, packages=packages, update_cache=update_cache))
 
-        # FIXME: do we want to run apt-update first?
-        self._tasks.append({
-            "name": title,
-            "become": True,
-            "apt": detail
-        })
+    def _flush_copies(self) -> None:
+        if self._pending_upload is not None:
+            self._tasks.append(self._pending_upload)
+            self._pending_upload = None
+
+    def _flush(self) -> None:
+        self._flush_apt()
+        self._flush_copies()
+
+    def _append(self, task: _AnyTask) -> None:
+        # flush pending apt packages and uploads first so that task order is
+        # preserved
+        self._flush()
+        self._tasks.append(task)
 
     def unixgroup(
         self,
@@ -60,7 +389,7 @@ class Block:
         if system:
             groupinfo['system'] = 'yes'
 
-        self._tasks.append({
+        self._append({
             "name": f'{verb} unix group {name!r}',
             "ansible.builtin.group": groupinfo,
             "become": True,
@@ -91,7 +420,7 @@ class Block:
         if system:
             userinfo['system'] = 'yes'
 
-        self._tasks.append({
+        self._append({
             "name": f'{verb} unix user {name!r}',
             "ansible.builtin.user": userinfo,
             "become": True,
@@ -99,28 +428,23 @@ class Block:
         })
 
     def mkdir(self, path: str, *, owner: str = 'root', mode: str) -> None:
-        self._tasks.append({
-            "name": f"mkdir {path}",
-            "become": True,
-            "file": {
-                "path": path,
-                "state": "directory",
-                "owner": owner,
-                "group": owner,
-                "mode": mode,
-            },
-        })
+        self._append(_FileTask(
+            f"mkdir {path}",
+            path=path,
+            state="directory",
+            owner=owner,
+            group=owner,
+            mode=mode,
+        ))
 
     def unlink(self, path: str, *, become: str = 'root') -> None:
-        self.other(
-            name=f"Unlink (rm) {path}",
-            become=become,
-            file={
-                "path": path,
-                "state": "absent",
-                "force": True,
-            },
-        )
+        self._append(_FileTask(
+            f"Unlink (rm) {path}",
+            become_user=become,
+            path=path,
+            state="absent",
+            force=True,
+        ))
 
     def symlink(
         self,
@@ -133,22 +457,20 @@ class Block:
         force: bool = False,
         become: str = None,
     ) -> None:
-        self.other(
+        self._append(_FileTask(
             f"Create '{path}' symlink to {src}",
-            become=become or owner,
-            file={
-                "path": path,
-                "state": "link",
-                "src": src,
-                "owner": owner,
-                "group": group,
-                "mode": mode,
-                # Force the creation of the symlinks in two cases: the source file does not exist (but
-                # will appear later); the destination exists and is a file (so, we need to unlink the
-                # path file and create symlink to the src file in place of it).
-                "force": force,
-            },
-        )
+            become_user=become or owner,
+            path=path,
+            state="link",
+            src=src,
+            owner=owner,
+            group=group,
+            mode=mode,
+            # Force the creation of the symlinks in two cases: the source file does not exist (but
+            # will appear later); the destination exists and is a file (so, we need to unlink the
+            # path file and create symlink to the src file in place of it).
+            force=force,
+        ))
 
     def other(
         self,
@@ -157,11 +479,11 @@ class Block:
         become: str,
         **detail: Any,
     ) -> None:
-        self._tasks.append({
+        self._append({
             # see https://docs.ansible.com/ansible/latest/modules/ufw_module.html
             "name": name,
             "become": True,
-            "become_user": become,
+            "become_user": _intern(become),
             **detail,
         })
 
@@ -185,9 +507,9 @@ class Block:
             }
         }
 
-        task['become_user'] = owner
+        task['become_user'] = _intern(owner)
 
-        self._tasks.append(task)
+        self._append(task)
 
     def command(
         self,
@@ -196,21 +518,7 @@ class Block:
         chdir: str = None,
         become: str = None,
     ) -> None:
-        # See https://docs.ansible.com/ansible/latest/modules/command_module.html#command-module
-        detail: Dict[str, Any] = {
-            "argv": command,
-        }
-        if chdir is not None:
-            detail['chdir'] = chdir
-        task: dict[str, Any] = {
-            "name": title,
-            "command": detail,
-        }
-        if become is not None:
-            task['become'] = True
-            task['become_user'] = become
-
-        self._tasks.append(task)
+        self._append(_CommandTask(title, argv=command, chdir=chdir, become_user=become))
 
     def copy(
         self,
@@ -223,59 +531,134 @@ class Block:
         owner: str = None,
         mode: int = None
     ) -> None:
-        # https://docs.ansible.com/ansible/latest/modules/copy_module.html
-        how = {
-            "dest": dest,
-            "backup": True,
-        }
-
+        self._append(self._copy_task(
+            title=title,
+            src=src,
+            content=content,
+            dest=dest,
+            root=root,
+            owner=owner,
+            mode=mode,
+        ))
+
+    def copy_many(
+        self,
+        srcs: List[Union[str, Path]],
+        destdir: str,
+        *,
+        root: bool = False,
+        owner: str = None,
+        mode: Union[int, str] = None
+    ) -> None:
+        # Upload several files into <destdir>. Files sent to the same
+        # destination by consecutive calls are uploaded with a single
+        # synchronize task (without the backups that copy() would make).
+        if not srcs:
+            return
+        self._flush_apt()
+        pending = self._pending_upload
+        root = root or bool(owner)
+        if pending is None or (pending.destdir, pending.owner, pending.mode, pending.root) != (destdir, owner, mode, root):
+            self._flush_copies()
+            pending = self._pending_upload = _UploadBatch(destdir, owner=owner, mode=mode, root=root)
+        for src in srcs:
+            # resolve every source up front so that it means the same thing
+            # whether it ends up in a copy or a synchronize task
+            pending.srcs.append((self._root / src).absolute())
+
+    def _copy_task(
+        self,
+        *,
+        title: str = None,
+        src: Union[str, Path] = None,
+        content: str = None,
+        dest: str,
+        root: bool = False,
+        owner: str = None,
+        mode: int = None
+    ) -> _CopyTask:
         if title is None:
             title = f"Upload {basename(src)} to {dest}" if src else f"Create {dest}"
 
         if src is not None:
             assert content is None
             if isinstance(src, Path):
-                how['src'] = str(src)
+                src = os.fspath(src)
             else:
-                how['src'] = str(self._root / src)
+                src = os.fspath(self._root / src)
         else:
             assert content is not None
-            how['content'] = content
 
-        if mode is not None:
-            how['mode'] = mode
-
-        task: Dict[str, Any] = {
-            "name": title,
-            "copy": how,
-        }
-
-        if root or owner:
-            task["become"] = True
-            task["become_user"] = 'root'
-
-        if owner:
-            how['owner'] = owner
-
-        self._tasks.append(task)
-
-    def get_tasks(self) -> Iterator[Dict[str, Any]]:
-        for task in self._tasks:
-            if isinstance(task, dict):
-                yield task
-            else:
-                assert isinstance(task, Block)
-                yield {
-                    "name": task._name,
-                    "block": list(task.get_tasks()),
-                }
+        return _CopyTask(title, dest=dest, src=src, content=content, mode=mode, owner=owner, root=root)
+
+    def get_tasks(self, *, dedupe: bool = False, staging: Path = None) -> List[Dict[str, Any]]:
+        # Walk the tree of nested blocks with an explicit stack instead of
+        # recursing. Each nested block's dict is added to its parent's list
+        # straight away and its "block" list is filled in when the block is
+        # popped off the stack, so every task is visited exactly once.
+        # With dedupe=True, repeats of an identical top-level task are dropped;
+        # tasks inside nested blocks are always kept as they are.
+        # staging: directory for copy_many() to collect its files in; without
+        # it, every file gets its own copy task.
+        result: List[Dict[str, Any]] = []
+        seen: Set[str] = set()
+        stack: Deque[Tuple[Block, List[Dict[str, Any]]]] = deque([(self, result)])
+        while stack:
+            block, out = stack.pop()
+            block._flush()
+            for task in block._tasks:
+                if isinstance(task, Block):
+                    children: List[Dict[str, Any]] = []
+                    out.append({
+                        "name": task._name,
+                        "block": children,
+                    })
+                    stack.append((task, children))
+                    continue
+
+                if isinstance(task, _UploadBatch):
+                    rendered = task.to_dicts(staging)
+                elif isinstance(task, _Task):
+                    rendered = [task.to_dict()]
+                else:
+                    rendered = [task]
+                for taskdict in rendered:
+                    if dedupe and out is result:
+                        key = json.dumps(taskdict, sort_keys=True)
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                    out.append(taskdict)
+        return result
+
+    def build_parallel(self, builders: List[Callable[["Block"], None]], *, max_workers: int = None) -> None:
+        # Run each builder against its own Block in a separate process and
+        # append the resulting tasks in the order the builders were given.
+        # Builders must be picklable, i.e. defined at module level.
+        self._flush()
+        # collect every result before touching self._tasks, so that a failing
+        # builder doesn't leave the block with only some of the tasks added
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_build_tasks, builders, [self._root] * len(builders)))
+        for tasks in results:
+            self._tasks.extend(tasks)
 
     def get_block(self, name: str) -> "Block":
         block = Block(name, root=self._root)
-        self._tasks.append(block)
+        self._append(block)
         return block
 
 
+def _build_tasks(builder: Callable[[Block], None], root: Path) -> List[_AnyTask]:
+    # runs in a worker process for Block.build_parallel(); the tasks are
+    # returned unrendered so that copy_many() uploads are only staged once the
+    # playbook is written
+    block = Block("build_parallel", root=root)
+    builder(block)
+    block._flush()
+    return block._tasks
+
+
 class Play(Block):
     def __init__(self, name: str, *, root: Path):
         assert '/' not in name
@@ -283,26 +666,143 @@ class Play(Block):
 
         super().__init__(name, root=root)
 
-    def run_play(self, *, hosts: str, saveas: Path = None, verbosity: int = 0) -> None:
-        if saveas is None:
-            with TemporaryDirectory() as tmpdir:
-                self._run_play(saveas=Path(tmpdir) / self._name, hosts=hosts, verbosity=verbosity)
-        else:
-            self._run_play(saveas=saveas, hosts=hosts, verbosity=verbosity)
-
-    def _run_play(self, *, hosts: str, saveas: Path, verbosity: int) -> None:
-        assert len(self._tasks), "No tasks"
-
-        log.info(f"Generating playbook {important(saveas.relative_to(self._root))}")
-        with open(saveas, 'w') as f:
-            yaml.dump([{"hosts": hosts, "tasks": list(self.get_tasks())}], f)
-
-        # note: our environment should already contain $ANSIBLE_CONFIG and
-        # $ANSIBLE_INVENTORY
-        cmd = [
-            'ansible-playbook',
-            str(saveas),
-        ]
-        cmd.extend(['--verbose'] * verbosity)
-        log.info(f"Running ansible-playbook {important(saveas.relative_to(self._root))}")
-        run(cmd, cwd=self._root, check=True)
+    def run_play(
+        self,
+        *,
+        hosts: str,
+        saveas: Path = None,
+        verbosity: int = 0,
+        fact_cache_dir: Path = None,
+        forks: Optional[int] = 20,
+        pipelining: Optional[bool] = True,
+        close_fds: bool = True,
+        strategy: str = None,
+        serial: Union[int, str, List[Union[int, str]]] = None,
+        dedupe: bool = False,
+    ) -> None:
+        # see PlaySpec and run_plays() for what the arguments do
+        run_plays(
+            [PlaySpec(self, hosts, strategy=strategy, serial=serial)],
+            saveas=saveas,
+            verbosity=verbosity,
+            fact_cache_dir=fact_cache_dir,
+            forks=forks,
+            pipelining=pipelining,
+            close_fds=close_fds,
+            dedupe=dedupe,
+        )
+
+    def _write_play(self, f: TextIO, *, header: Dict[str, Any], dedupe: bool, staging: Path) -> None:
+        # Tasks are dumped one at a time rather than as one big document so
+        # that we never hold all the tasks' JSON in memory at once.
+        # strip the closing brace so the tasks can be added to the play
+        f.write(_dump(header)[:-1])
+        f.write(',"tasks":[')
+        for i, task in enumerate(self.get_tasks(dedupe=dedupe, staging=staging)):
+            if i:
+                f.write(",\n")
+            f.write(_dump(task))
+        f.write("]}")
+
+
+class PlaySpec(NamedTuple):
+    # A Play together with the hosts it targets and its optional strategy and
+    # serial settings, for run_plays().
+    # strategy/serial: see https://docs.ansible.com/ansible/latest/user_guide/playbooks_strategies.html
+    play: Play
+    hosts: str
+    strategy: Optional[str] = None
+    serial: Union[int, str, List[Union[int, str]], None] = None
+
+
+def run_plays(
+    plays: List[PlaySpec],
+    *,
+    saveas: Path = None,
+    verbosity: int = 0,
+    fact_cache_dir: Path = None,
+    forks: Optional[int] = 20,
+    pipelining: Optional[bool] = True,
+    close_fds: bool = True,
+    dedupe: bool = False,
+) -> None:
+    # Write all the plays into a single playbook, one play document each with
+    # its own hosts/strategy/serial, and run it with one ansible-playbook
+    # invocation so that ansible only has to start up once. Note that each
+    # play still gathers facts for its hosts unless smart gathering is enabled,
+    # e.g. with fact_cache_dir.
+    # dedupe: drop repeats of identical top-level tasks within each play, e.g.
+    # the same mkdir() requested from several places; not safe when a
+    # command() is meant to run more than once
+    # fact_cache_dir: cache gathered facts as JSON files in this directory
+    # so that later runs only gather facts for hosts that aren't cached
+    # forks/pipelining: override ansible's defaults of 5 forks and no
+    # pipelining; pass None to use the values from $ANSIBLE_CONFIG instead
+    # close_fds: pass False to skip closing the parent's file descriptors
+    # when spawning ansible-playbook, which is slow on kernels without
+    # close_range() when the parent has many files open
+    assert len(plays), "No plays"
+    env = _ansible_env(fact_cache_dir=fact_cache_dir, forks=forks, pipelining=pipelining)
+    if saveas is None:
+        with TemporaryDirectory() as tmpdir:
+            saveas = Path(tmpdir) / plays[0].play._name
+            _run_plays(plays, saveas=saveas, verbosity=verbosity, env=env, close_fds=close_fds, dedupe=dedupe)
+    else:
+        _run_plays(plays, saveas=saveas, verbosity=verbosity, env=env, close_fds=close_fds, dedupe=dedupe)
+
+
+def _run_plays(
+    plays: List[PlaySpec],
+    *,
+    saveas: Path,
+    verbosity: int,
+    env: Dict[str, str],
+    close_fds: bool,
+    dedupe: bool,
+) -> None:
+    root = plays[0].play._root
+    for spec in plays:
+        spec.play._flush()
+        assert len(spec.play._tasks), f"No tasks in {spec.play._name}"
+
+    # chromalog is only needed once we're running plays, so don't slow
+    # down importing this module with it
+    from chromalog.mark.helpers.simple import important
+
+    log.info(f"Generating playbook {important(saveas.relative_to(root))}")
+    # The playbook is written as JSON, which ansible loads just like YAML but
+    # which is much cheaper to generate. Write to a temporary file first so
+    # that a failure part-way through never leaves a truncated playbook at
+    # <saveas>.
+    # Files for copy_many() are collected in <saveas>.staging/. It is kept for
+    # as long as the playbook is, so that a saved playbook can be re-run by
+    # hand; without saveas both live in a temporary directory.
+    tmp = saveas.with_name(saveas.name + '.tmp')
+    staging = saveas.with_name(saveas.name + '.staging')
+    try:
+        if staging.exists():
+            shutil.rmtree(staging)
+        staging.mkdir()
+        with open(tmp, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            f.write("[")
+            for i, spec in enumerate(plays):
+                if i:
+                    f.write(",\n")
+                header = _play_header(hosts=spec.hosts, strategy=spec.strategy, serial=spec.serial)
+                spec.play._write_play(f, header=header, dedupe=dedupe, staging=staging)
+            f.write("]\n")
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, saveas)
+
+    # note: our environment should already contain $ANSIBLE_CONFIG and
+    # $ANSIBLE_INVENTORY
+    cmd = [
+        'ansible-playbook',
+        str(saveas),
+    ]
+    cmd.extend(['--verbose'] * verbosity)
+
+    log.info(f"Running ansible-playbook {important(saveas.relative_to(root))}")
+    run(cmd, cwd=root, check=True, env=env, close_fds=close_fds)
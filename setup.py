@@ -9,7 +9,6 @@ setup(
     packages=['python_ansible_wrapper'],
     package_data={'python_ansible_wrapper': ['py.typed', '**/py.typed']},
     install_requires=[
-        'pyyaml',
         'chromalog',
     ],
 )